@@ -1,8 +1,25 @@
 #!/usr/bin/python3
 # -*- coding: utf-8 -*-
 
-import asyncio, logging
-import aiomysql
+import asyncio, logging, itertools, functools, os, time
+from collections import OrderedDict
+
+ORM_DRIVER = os.environ.get('ORM_DRIVER', 'aiomysql')   # 数据库驱动：aiomysql，或接口兼容、速度更快的asyncmy
+if ORM_DRIVER == 'asyncmy':
+    import asyncmy as driver
+    from asyncmy.cursors import SSCursor
+else:
+    import aiomysql as driver
+    from aiomysql import SSCursor
+
+FIND_CACHE_SIZE = 1024      # 主键查询缓存的最大记录数
+FIND_CACHE_TTL = 60         # 主键查询缓存的有效期(秒)，其他进程或直接执行sql修改的记录最多在这段时间内是旧的
+FIND_ALL_LIMIT = 1000       # findAll未指定limit时最多返回的记录数，需要遍历全表请使用iter_all
+REQUIRE_LIMIT = os.environ.get('ORM_REQUIRE_LIMIT') == '1'  # 为1时findAll必须指定limit
+_find_cache = OrderedDict()     # 主键查询缓存：(表名, 主键名, 主键值) ==> (过期时间, 记录)，按最近使用排序
+_find_loading = dict()      # 正在查询的缓存键 ==> 本次查询的标记，查询期间记录被修改则标记被删除，查询结果不再写入缓存
+_pending_finds = dict()     # 同一轮事件循环中等待合并的find：模型类 ==> {主键值: future}
+_flush_tasks = set()    # 正在执行的合并查询任务，保持引用，避免任务在执行中被垃圾回收
 
 
 def log(sql, args=()):
@@ -12,7 +29,7 @@ def log(sql, args=()):
     :param args: 格式化参数
     :return:None
     """
-    logging.info('SQL: %s' % sql)
+    logging.info('SQL: %s', sql)     # 由logging在需要输出时才格式化
 
 
 async def create_pool(loop, **kw):
@@ -22,85 +39,285 @@ async def create_pool(loop, **kw):
     :param kw: 关键字参数,用于传递host, port, user, password, db等数据库连接参数
     :return:None
     """
-    logging.info('create database connection pool')
+    logging.info('create database connection pool (driver: %s)', ORM_DRIVER)
+    if ORM_DRIVER == 'asyncmy':
+        driver_kw = dict(database=kw['db'])     # asyncmy沿用PyMySQL的参数名，连接池使用当前运行的事件循环
+    else:
+        driver_kw = dict(db=kw['db'], loop=loop)    # 需要传递一个事件循环实例，若无特别声明，默认使用asyncio.get_event_loop()
     global __pool   # 将连接池定义为全局私有变量(obj)
-    __pool = await aiomysql.create_pool(
+    __pool = await driver.create_pool(
         host=kw.get('host', 'localhost'),       # 主机ip，默认本机
         port=kw.get('port', 3306),              # 端口，默认3306
         user=kw.get('user', 'root'),            # 用户，默认root
         password=kw.get('password', 'root'),    # 用户口令，默认root
-        db=kw['db'],                            # 选择数据库
         charset=kw.get('charset', 'utf8'),      # 设置数据库编码，默认utf8
         autocommit=kw.get('autocommit', True),  # 设置自动提交事务，默认打开
         maxsize=kw.get('maxsize', 10),          # 设置最大连接数，默认10
         minsize=kw.get('minsize', 1),           # 设置最小连接数，默认1
-        loop=loop,                              # 需要传递一个事件循环实例，若无特别声明，默认使用asyncio.get_event_loop()
+        **driver_kw                             # 选择数据库等和驱动相关的参数
     )
 
 
 async def select(sql, args, size=None):
     """
     实现sql语句：select(查询)
-    :param sql: 查询sql
+    :param sql: 查询sql，占位符已是mysql的%s（模型的sql在元类中预先转换好）
     :param args: sql占位符的参数集
     :param size: 返回size条的记录, limit n
-    :return: 返回查询的记录
+    :return: 返回查询的记录，每条记录是一个tuple
     """
     log(sql, args)
     global __pool   # 使用全局变量__pool
-    async with __pool.acquire as conn:  # 从连接池中获取一个连接，使用完后自动释放
-        async with conn.cursor(aiomysql.DictCursor) as cursor:  # 创建一个游标，返回由dict组成的list，使用完后自动释放
-            await cursor.execute(sql.replace('?', '%s'), args or ())    # 执行sql，mysql的占位符是%s，和python一样，为了coding方便，先用sql的占位符?写sql语句，最后执行时转换过来
+    async with __pool.acquire() as conn:  # 从连接池中获取一个连接，使用完后自动释放
+        async with conn.cursor() as cursor:  # 创建一个游标，返回由tuple组成的list，省去每行构造dict的开销，使用完后自动释放
+            await cursor.execute(sql, args or ())    # 执行sql，mysql的占位符是%s，为了coding方便，先用sql的占位符?写sql语句，在元类中一次性转换好，执行时不再逐条替换
             if size:
                 rs = await cursor.fetchmany(size)   # 只读取size条记录
             else:
-                rs = await cursor.fetchall()    # rs是一个list，每个元素都是一个dict，一个dict代表一行记录
+                rs = await cursor.fetchall()    # rs是一个list，每个元素都是一个tuple，一个tuple代表一行记录，顺序与select的列一致
 
-        logging.info('rows returned: %s' % len(rs))
+        logging.info('rows returned: %s', len(rs))
         return rs
 
 
+async def select_iter(sql, args, chunk=500):
+    """
+    实现sql语句：select(流式查询)，使用服务端游标边读边返回，不把整个结果集缓存在内存里
+    :param sql: 查询sql，占位符为%s
+    :param args: sql占位符的参数集
+    :param chunk: 每次从服务端读取的记录数，整批读取比逐行读取快得多（逐行读取每一行都要经过一次协程切换）
+    :return: 异步生成器，逐条返回记录(tuple)，提前退出遍历时需要调用aclose()归还连接
+    """
+    log(sql, args)
+    async with __pool.acquire() as conn:    # 遍历结束前一直占用这个连接
+        async with conn.cursor(SSCursor) as cursor:  # 服务端游标，记录留在服务端按需读取
+            await cursor.execute(sql, args or ())
+            while True:
+                rs = await cursor.fetchmany(chunk)
+                if not rs:
+                    break
+                for r in rs:
+                    yield r
+
+
 async def execute(sql, args, autocommit=True):
     """
     实现sql语句：INSERT, UPDATE, DELETE.
-    :param sql: sql语句
+    :param sql: sql语句，占位符为%s
     :param args: sql占位符对应的参数集
     :param autocommit:  自动提交事务
     :return:
     """
     log(sql)
-    async with __pool.acquire as conn:  # 获取一个连接
+    async with __pool.acquire() as conn:  # 获取一个连接
         if not autocommit:
             await conn.begin()  # 协程启动
         try:
-            async with conn.cursor(aiomysql.DictCursor) as cursor:  # 创建一个字典游标，返回字典类型为元素的list
-                await cursor.execute(sql.replace('?', '%s') % args or ())   # 执行sql
+            async with conn.cursor() as cursor:  # 创建一个游标，只需要受影响的行数
+                await cursor.execute(sql, args or ())   # 执行sql，由驱动绑定参数，不要用%格式化拼接
                 affected = cursor.rowcount  # 获得影响的行数
 
             if not autocommit:
                 await conn.commit()     # 提交事务
 
-        except BaseException as e:
+        except Exception:   # 任务被取消(CancelledError)时直接向上抛出，不在已失效的连接上回滚
             if not autocommit:
                 await conn.rollback()   # 回滚当前启动的协程
             raise
         return affected     # 返回受影响的行数
 
 
+async def pipeline(stmts):
+    """
+    在同一个连接上连续执行多条sql，整体作为一个事务提交，省去每条sql获取、释放连接的开销
+    :param stmts: (sql, args)组成的序列，占位符为%s
+    :return: 每条sql对应的(受影响的行数, 返回的记录)组成的list
+    """
+    async with __pool.acquire() as conn:  # 所有sql共用一个连接
+        await conn.begin()
+        try:
+            results = []
+            async with conn.cursor() as cursor:
+                for sql, args in stmts:     # 逐条发送，中间不穿插其他业务逻辑
+                    log(sql, args)
+                    await cursor.execute(sql, args or ())
+                    results.append((cursor.rowcount, await cursor.fetchall()))
+
+            await conn.commit()
+
+        except Exception:   # 任务被取消(CancelledError)时直接向上抛出，不在已失效的连接上回滚
+            await conn.rollback()
+            raise
+        return results
+
+
+def _cache_forget(cls, pk):
+    """
+    记录被写入后，从主键查询缓存中删除对应的记录
+    :param cls: 模型类
+    :param pk: 主键值
+    :return: None
+    """
+    key = (cls.__table__, cls.__primary_key__, pk)
+    _find_cache.pop(key, None)
+    _find_loading.pop(key, None)    # 正在进行的查询可能读到了修改前的记录
+
+
+def _match_key(pk):
+    """
+    把主键值转换成可比较的形式，近似mysql的比较规则：'5'和5相等，默认排序规则下字符串不区分大小写
+    只用于数据库返回的记录无法按主键值精确匹配时
+    :param pk: 主键值
+    :return: 转换后的值
+    """
+    return str(pk).casefold()
+
+
+def _cache_get(key):
+    """
+    从主键查询缓存中读取记录
+    :param key: 缓存键
+    :return: 记录，没有缓存或已过期则返回None
+    """
+    entry = _find_cache.get(key)
+    if entry is None:
+        return None
+    if entry[0] < time.monotonic():     # 已过期，重新查询数据库
+        del _find_cache[key]
+        return None
+    _find_cache.move_to_end(key)
+    return entry[1]
+
+
+def _cache_store(key, row):
+    """
+    把记录写入主键查询缓存
+    :param key: 缓存键
+    :param row: 记录，dict
+    :return: None
+    """
+    _find_cache[key] = (time.monotonic() + FIND_CACHE_TTL, row)
+    _find_cache.move_to_end(key)    # 已存在的键也移到最近使用的位置
+    if len(_find_cache) > FIND_CACHE_SIZE:  # 超出容量时淘汰最久未使用的记录
+        _find_cache.popitem(last=False)
+
+
+async def _flush_finds(cls):
+    """
+    把同一轮事件循环中发起的find合并成一次find_many查询，再把结果分发给各自的future
+    :param cls: 模型类
+    :return: None
+    """
+    batch = _pending_finds.pop(cls)     # 之后发起的find会进入新的批次
+    try:
+        objs = await cls.find_many(list(batch))
+    except Exception as e:
+        for fut in batch.values():
+            if not fut.done():
+                fut.set_exception(e)
+                fut.exception()     # 标记异常已被读取，等待的find都被取消时不会报exception was never retrieved
+    else:
+        for pk, fut in batch.items():
+            if not fut.done():
+                fut.set_result(objs.get(pk))
+    finally:
+        for fut in batch.values():  # 查询被取消时，等待中的find也一起取消，不会一直挂起
+            if not fut.done():
+                fut.cancel()
+
+
+@functools.lru_cache(maxsize=64)    # 同一个模型的占位符个数总是相同的
 def create_args_string(num):
     """
     按参数个数制作占位符字符串，用于生产sql
     :param num: 占位符个数
     :return: 占位符字符串
     """
-    L = []
-    for i in range(num):    # sql占位符是?，num是多少就插入多少个占位符
-        L.append('?')
-    return ', '.join(L)     # 将list拼接成字符串返回，例如：num=3:'?, ?, ?
+    return '' if num == 0 else '?' + ', ?' * (num - 1)     # sql占位符是?，例如：num=3:'?, ?, ?'
+
+
+@functools.lru_cache(maxsize=256)   # 常见的修改组合只格式化一次
+def _update_sql(cls, cols):
+    """
+    生成只更新指定列的update语句
+    :param cls: 模型类
+    :param cols: 需要更新的列，tuple，按__fields__的顺序排列
+    :return: update语句，占位符为%s
+    """
+    return 'update `%s` set %s where `%s`=%%s' % (cls.__table__, ', '.join('`%s`=%%s' % (cls.__mappings__[f].name or f) for f in cols), cls.__primary_key__)
+
+
+def _insert_args_extractor(field_defaults):
+    """
+    类创建时为模型生成提取insert参数的函数，save时不再逐列查询__mappings__
+    :param field_defaults: (列名, 默认值, 默认值是否可调用)组成的tuple，顺序与insert语句的参数一致
+    :return: 函数，传入模型对象，返回参数tuple
+    """
+    cols = tuple(k for k, _, _ in field_defaults)
+    n = len(cols)
+    get, setitem = dict.get, dict.__setitem__
+    fill = tuple((i, k, default, is_call) for i, (k, default, is_call) in enumerate(field_defaults) if default is not None)    # 只有这些列需要补默认值
+
+    def extract(obj):
+        values = list(map(get, itertools.repeat(obj, n), cols))
+        for i, k, default, is_call in fill:
+            if values[i] is None:
+                values[i] = value = default() if is_call else default
+                setitem(obj, k, value)   # 和getValueOrDefault一样，把默认值写回对象
+        return tuple(values)
+
+    return extract
+
+
+def _rows_decoder(cls):
+    """
+    类创建时为模型生成把查询结果转换成对象的函数，列名直接写进代码，每行只需一次解包和一次dict初始化
+    :param cls: 模型类
+    :return: 函数，传入select返回的tuple列表，返回对象列表
+    """
+    names = ['c%d' % i for i in range(len(cls.__select_cols__))]
+    src = '\n'.join([
+        'def __decode_rows__(rows):',
+        '    out = []',
+        '    append = out.append',
+        '    for %s, in rows:' % ', '.join(names),     # 行的列数和__select__查询的列一致
+        '        o = new(cls)',
+        '        init(o, {%s})' % ', '.join('%r: %s' % (c, n) for c, n in zip(cls.__select_cols__, names)),
+        '        append(o)',
+        '    return out',
+    ])
+    namespace = dict(new=cls.__new__, init=dict.__init__, cls=cls)
+    exec(compile(src, '<%s.__decode_rows__>' % cls.__name__, 'exec'), namespace)
+    return namespace['__decode_rows__']
+
+
+class ORMError(Exception):
+    """ orm相关异常的基类 """
+    pass
+
+
+class PrimaryKeyError(ORMError):
+    """ 模型没有定义主键或定义了多个主键 """
+    pass
+
+
+def _rebuild_model(cls, row, dirty):
+    """
+    copy、pickle还原模型对象，不经过__init__和__setitem__
+    :param cls: 模型类
+    :param row: 列值，dict
+    :param dirty: 被修改过的列
+    :return: 模型对象
+    """
+    obj = cls.__new__(cls)
+    dict.__init__(obj, row)
+    object.__setattr__(obj, '_dirty', set(dirty))
+    return obj
 
 
 class Field(object):
     """ 定义一个数据类型基类，用于衍生各种在orm中对应数据库的数据类型的类 """
+    __slots__ = ('name', 'column_type', 'primary_key', 'default')   # 固定属性，不为每个实例创建__dict__
 
     def __init__(self, name, column_type, primary_key, default):
         """ 参数：字段名，数据类型，主键，默认值 """
@@ -116,6 +333,7 @@ class Field(object):
 
 class StringField(Field):
     """ 定义一个字符串类， 继承Field, 在orm中对应数据库的字符类型，默认varchar(100) """
+    __slots__ = ()
 
     def __init__(self, name=None, primary_key=False, default=None, ddl='varchar(100)'):
         """ 参数：字段名，主键，默认值，数据类型 """
@@ -124,6 +342,7 @@ class StringField(Field):
 
 class BooleanField(Field):
     """ 定义一个布尔类，继承Field, 在orm中对应数据库的布尔类型 """
+    __slots__ = ()
 
     def __init__(self, name=None, default=False):
         """ 参数：字段名，默认值 """
@@ -132,6 +351,7 @@ class BooleanField(Field):
 
 class IntegerField(Field):
     """ 定义整型类，继承Field，在orm中对应数据库的整型类型，默认BIGINT """
+    __slots__ = ()
 
     def __init__(self, name=None, column_type='bigint', primary_key=False, default=0):
         """ 参数：字段名，主键，默认值，数据类型 """
@@ -140,6 +360,7 @@ class IntegerField(Field):
 
 class FloatField(Field):
     """ 定义浮点型类，继承Field, 在orm中对应数据库的 REAL 双精度浮动数类型 """
+    __slots__ = ()
 
     def __init__(self, name=None, column_type='real', primary_key=False, default=0.0):
         """ 参数：字段名，主键，默认值，数据类型 """
@@ -148,6 +369,7 @@ class FloatField(Field):
 
 class TextField(Field):
     """ 定义文本型类，继承Field, 在orm中对应数据的 TEXT 长文本类型 """
+    __slots__ = ()
 
     def __init__(self, name=None, column_type='text', default=None):
         """ 参数：字段名，主键，默认值，数据类型 """
@@ -161,46 +383,67 @@ class ModelMetaclass(type):
         """ 用metaclass=ModelMetaclass创建类时，通过这个方法生成类 """
         if name == 'Model':     # 定制Model类（排除本身）
             return type.__new__(cls, name, bases, attrs)    # 当前准备创建的类的对象、类名、类继承的基类集合、类的方法集合
+        attrs.setdefault('__slots__', ())   # 列值都存放在dict里，实例不需要__dict__
         tableName = attrs.get('__table__', None) or name    # 获取表名，默认None, 或为类名
-        logging.info('found model: %s (table: %s)' % (name, tableName))     # 类名、表名
+        verbose = logging.getLogger().isEnabledFor(logging.INFO)    # 日志级别高于INFO时不输出模型信息
+        if verbose:
+            logging.info('found model: %s (table: %s)', name, tableName)     # 类名、表名
         mappings = dict()   # 用于存储字段名和对应的数据类型
         fields = []     # 用于存储非主键的列
         primaryKey = None   # 用于主键查重，默认为None
+        to_remove = []  # 遍历时不能修改attrs，先记下列名
 
-        for k, v in attrs.items():      # 遍历attrs方法集合
-            if isinstance(k, Field):    # 提取数据类的列
-                logging.info(' found mappings: %s ==> %s' % (k, v))
+        for k, v in attrs.items():      # 遍历attrs方法集合，一次完成列、主键的提取
+            if isinstance(v, Field):    # 提取数据类的列，k是属性名，v才是Field
+                if verbose:
+                    logging.info(' found mappings: %s ==> %s', k, v)
                 mappings[k] = v     # 存储列名和数据类型
+                to_remove.append(k)
                 if v.primary_key:   # 查找主键和查重，有重复则抛出异常
                     if primaryKey:
-                        raise BaseException('Duplicate primary key for field: %s' % k)
+                        raise PrimaryKeyError('Duplicate primary key for field: %s' % k)
                     primaryKey = k
                 else:
                     fields.append(k)    # 存储非主键字段
 
         if not primaryKey:  # 主键不存在，则抛出异常
-            raise BaseException('Primary key not found.')
-        for k in mappings.keys():   # 过滤掉列，只剩方法
-            attrs.pop(k)
+            raise PrimaryKeyError('Primary key not found.')
+        for k in to_remove:   # 过滤掉列，只剩方法
+            del attrs[k]
 
-        escaped_fields = list(map(lambda f: '`%s`' % f, fields))    # 给非主键列加``(可执行命令)区别于''(字符串效果)
+        escaped_fields = ['`%s`' % f for f in fields]    # 给非主键列加``(可执行命令)区别于''(字符串效果)
         fields_str = ', '.join(escaped_fields)
         attrs['__mappings__'] = mappings    # 保持主键和列的映射关系
         attrs['__table__'] = tableName      # 表名
         attrs['__primary_key__'] = primaryKey   # 主键名
-        attrs['__fields__'] = fields    # 除主键外的属性名
-        attrs['__select__'] = 'select `%s`, `%s` from `%s`' % (primaryKey, fields_str, tableName)    # 构造select语句，查询全表
-        attrs['__insert__'] = 'insert into `%s` (`%s`, `%s`) value (%s)' % (tableName, fields_str, primaryKey, create_args_string(len(escaped_fields) + 1))     # 构造insert语句
-        attrs['__update__'] = 'update `%s` set %s where `%s`=?' % (tableName, ', '.join(map(lambda f: '`%s`=?' % (mappings.get(f).name or f), fields)), primaryKey)     # 构造update语句，根据主键更新对应一行记录，？占位符，待传入更新值和主键
+        attrs['__fields__'] = tuple(fields)    # 除主键外的属性名，用tuple保存，每次save遍历更快
+        attrs['__field_set__'] = frozenset(fields)  # 同上，用于快速判断一个键是否是非主键列
+        attrs['__select__'] = 'select `%s`, %s from `%s`' % (primaryKey, fields_str, tableName)    # 构造select语句，查询全表，fields_str中的列已加好``
+        attrs['__insert__'] = 'insert into `%s` (%s, `%s`) value (%s)' % (tableName, fields_str, primaryKey, create_args_string(len(escaped_fields) + 1))     # 构造insert语句
+        attrs['__update__'] = 'update `%s` set %s where `%s`=?' % (tableName, ', '.join('`%s`=?' % (mappings[f].name or f) for f in fields), primaryKey)     # 构造update语句，根据主键更新对应一行记录，？占位符，待传入更新值和主键
         attrs['__delete__'] = 'delete from `%s` where `%s`=?' % (tableName, primaryKey)     # 构建delete语句，根据主键删除对应的行
-        return type.__new__(cls, name, bases, attrs)    # 返回当前准备创建的类的对象、类的名字、类继承的基类集合、类的方法集合
+        attrs['__find__'] = '%s where `%s`=?' % (attrs['__select__'], primaryKey)    # 构造根据主键查询一行记录的select语句
+        for key in ('select', 'insert', 'update', 'delete', 'find'):    # 类创建时一次性把?替换成mysql的%s，执行时直接使用
+            attrs['__%s_sql__' % key] = attrs['__%s__' % key].replace('?', '%s')
+        attrs['__select_cols__'] = (primaryKey,) + attrs['__fields__']    # select语句返回的列的顺序：主键，非主键列
+        attrs['__insert_cols__'] = attrs['__fields__'] + (primaryKey,)    # insert/update语句中参数的顺序：非主键列，主键
+        attrs['__insert_row_sql__'] = '(%s)' % create_args_string(len(fields) + 1).replace('?', '%s')   # 一行记录的占位符，用于拼接多行insert
+        attrs['__insert_head_sql__'] = attrs['__insert_sql__'][:-len(attrs['__insert_row_sql__'])]  # insert语句去掉占位符后的部分
+        attrs['__field_defaults__'] = tuple((k, mappings[k].default, callable(mappings[k].default)) for k in attrs['__insert_cols__'])  # 每列的默认值和是否可调用，类创建时算好
+        attrs['__extract_insert_args__'] = staticmethod(_insert_args_extractor(attrs['__field_defaults__']))   # 按__insert_cols__的顺序返回insert参数
+        model = type.__new__(cls, name, bases, attrs)    # 当前准备创建的类的对象、类的名字、类继承的基类集合、类的方法集合
+        model.__decode_rows__ = staticmethod(_rows_decoder(model))     # 生成的函数要引用类本身，所以在类创建后添加
+        return model
 
 
 class Model(dict, metaclass=ModelMetaclass):
     """ 定义一个对应数据库数据类型的模板类，通过继承，子类有dict的特性和元类的类与属性的映射关系 """
     # 由模板类衍生其他类时，这个模板类没重新定义__new__()方法，因此会使用父类ModelMetaclass的__new__()来生成衍生类，从而实现ORM
+    __slots__ = ('_dirty',)  # 属性都映射到dict的键上，不创建实例__dict__；_dirty记录被修改过的列
+
     def __init__(self, **kw):
         super(Model, self).__init__(**kw)
+        object.__setattr__(self, '_dirty', {k for k in kw if k in self.__field_set__})    # 新建对象时传入的列都视为已修改；从数据库读出的对象不经过__init__
 
     def __getattr__(self, key):
         """ 动态属性获取 """
@@ -213,32 +456,44 @@ class Model(dict, metaclass=ModelMetaclass):
         """ 动态属性设置 """
         self[key] = value
 
+    def __setitem__(self, key, value):
+        """ 设置列值，同时记录被修改的非主键列，update时只更新这些列 """
+        dict.__setitem__(self, key, value)
+        if key in self.__field_set__:
+            try:
+                self._dirty.add(key)
+            except AttributeError:  # 从数据库读出的对象还没有_dirty
+                object.__setattr__(self, '_dirty', {key})
+
+    def __reduce_ex__(self, protocol):
+        """ copy和pickle时只保存列值和被修改过的列，_dirty不会变成dict的键，副本也不和原对象共用_dirty """
+        return _rebuild_model, (self.__class__, dict(self), set(getattr(self, '_dirty', ())))
+
     def getValue(self, key):
         """ 返回属性值，默认None """
-        return getattr(self, key, None)
+        return dict.get(self, key)  # 直接查dict，不经过__getattr__和KeyError异常
 
     def getValueOrDefault(self, key):
         """ 返回属性值，空则返回默认值 """
-        value = getattr(self, key, None)
+        value = dict.get(self, key)
         if value is None:
             field = self.__mappings__[key]  # 查询属性对应的列的数量的默认值
             if field.default is not None:
                 value = field.default() if callable(field.default) else field.default
-                logging.debug('using default value for %s:%s' % (key, str(value)))
-                setattr(self, key, value)
+                logging.debug('using default value for %s:%s', key, value)
+                self[key] = value
 
         return value
 
     @classmethod    # 类方法，对应查询方法，默认查整个表，通过where、limit设置查询条件
     async def findAll(cls, where=None, args=None, **kw):
         """ find objects by where clause. """
-        sql = [cls.__select__]  # 用一个列表存储select语句
+        sql = [cls.__select_sql__]  # 用一个列表存储select语句
         if where:   # 添加一个条件
             sql.append('where')
-            sql.append(where)
+            sql.append(where.replace('?', '%s'))    # 调用方传入的条件仍使用?占位符
 
-        if args is None:
-            args = []
+        args = list(args) if args else []   # 复制一份再追加limit参数，不修改调用方传入的list，也支持tuple
 
         orderBy = kw.get('orderBy', None)   # 对查询结果排序
         if orderBy:
@@ -246,19 +501,50 @@ class Model(dict, metaclass=ModelMetaclass):
             sql.append(orderBy)
 
         limit = kw.get('limit', None) # 截取查询结果
-        if limit is not None:
-            sql.append('limit')
-            if isinstance(limit, int):  # 截取当前limit条记录
-                sql.append('?')
-                args.append(limit)  # 整型追加到列表后面
-            elif isinstance(limit, tuple) and len(limit) == 2:  # 分页
-                sql.append('?, ?')
-                args.extend(limit)  # 将limit合并args列表里面
-            else:
-                raise ValueError('Invalid limit value: %s' % limit)
+        if limit is None:   # 不限制返回的记录数，表变大后会占满内存
+            if REQUIRE_LIMIT:
+                raise ValueError('findAll on %s requires a limit' % cls.__table__)
+            logging.warning('findAll on %s without limit, only the first %s rows returned', cls.__table__, FIND_ALL_LIMIT)
+            limit = FIND_ALL_LIMIT
+        sql.append('limit')
+        if isinstance(limit, int):  # 截取当前limit条记录
+            sql.append('%s')
+            args.append(limit)  # 整型追加到列表后面
+        elif isinstance(limit, tuple) and len(limit) == 2:  # 分页
+            sql.append('%s, %s')
+            args.extend(limit)  # 将limit合并args列表里面
+        else:
+            raise ValueError('Invalid limit value: %s' % limit)
+
+        rs = await select(' '.join(sql), args)   # 构造新的select语句，返回[(),(),()]
+        return cls.__decode_rows__(rs)   # 返回一个列表，每个元素都是一个dict，相当于一行记录
+
+    @classmethod    # 类方法，流式遍历查询结果，适合记录很多的查询
+    async def iter_all(cls, where=None, args=None, chunk=500, **kw):
+        """
+        iterate objects by where clause without buffering the whole result set.
+        提前退出遍历时请用contextlib.aclosing(Model.iter_all(...))包住，保证及时释放占用的连接
+        """
+        sql = [cls.__select_sql__]
+        if where:
+            sql.append('where')
+            sql.append(where.replace('?', '%s'))
 
-        rs = await select(' '.join(sql), args)   # 构造新的select语句，返回[{},{},{}]
-        return [cls(**r) for r in rs]   # 返回一个列表，每个元素都是一个dict，相当于一行记录
+        orderBy = kw.get('orderBy', None)
+        if orderBy:
+            sql.append('order by')
+            sql.append(orderBy)
+
+        cols = cls.__select_cols__
+        new, init = cls.__new__, dict.__init__
+        rows = select_iter(' '.join(sql), args, chunk)
+        try:
+            async for r in rows:
+                obj = new(cls)
+                init(obj, zip(cols, r))
+                yield obj
+        finally:    # 提前退出时立即关闭服务端游标并归还连接，不等垃圾回收
+            await rows.aclose()
 
     @classmethod    # 类方法，查询特定列，可通过where设置条件
     async def findNumber(cls, selectField, where=None, args=None):
@@ -266,41 +552,143 @@ class Model(dict, metaclass=ModelMetaclass):
         sql = ['select %s _num_ from %s' % (selectField, cls.__table__)]    # _num_是SQL的一个字段别名用法，AS关键字可以省略
         if where:   # 添加where字段
             sql.append('where')
-            sql.append(where)
+            sql.append(where.replace('?', '%s'))
 
         rs = await select(' '.join(sql), args, 1)
         if len(rs) == 0:
             return None
-        return rs[0]['_num_']  # 根据别名key取值
+        return rs[0][0]  # 只查询了_num_一列
 
     @classmethod    # 类方法，根据主键查询一条记录
     async def find(cls, pk):
         """ find object by primary key """
-        rs = await select('%s where `%s`=?'% (cls.__select__, cls.__primary_key__, [pk], 1))
-        if len(rs) == 0:
+        key = (cls.__table__, cls.__primary_key__, pk)     # 缓存键包含表名、主键名和主键值，不同的主键不会冲突
+        row = _cache_get(key)
+        if row is not None:     # 命中缓存，不再查询数据库
+            obj = cls.__new__(cls)
+            dict.__init__(obj, row)     # 不经过__init__，返回的对象没有被修改过的列
+            return obj
+
+        batch = _pending_finds.get(cls)
+        if batch is None:   # 本轮事件循环中第一个find，下一轮再统一查询
+            batch = _pending_finds[cls] = dict()
+            task = asyncio.ensure_future(_flush_finds(cls))
+            _flush_tasks.add(task)
+            task.add_done_callback(_flush_tasks.discard)
+        fut = batch.get(pk)
+        if fut is None:
+            fut = batch[pk] = asyncio.get_running_loop().create_future()
+        obj = await asyncio.shield(fut)     # 同一主键的find共用一个future，取消其中一个不影响其他
+        if obj is None:
             return None
-        return cls(**rs[0])     # 将dict作为关键字参数传入当前类的对象
+        row, obj = obj, cls.__new__(cls)
+        dict.__init__(obj, row)     # 每次返回新的对象，避免调用方之间共享数据
+        return obj
+
+    @classmethod    # 类方法，根据一组主键一次查询多条记录
+    async def find_many(cls, pks):
+        """ find objects by primary keys, returns {pk: object} keyed by the given pks """
+        pks = list(dict.fromkeys(pks))  # 去掉重复的主键
+        if not pks:
+            return dict()
+        keys = [(cls.__table__, cls.__primary_key__, pk) for pk in pks]
+        token = object()
+        for key in keys:
+            _find_loading[key] = token
+        try:
+            if len(pks) == 1:   # 只有一个主键时直接使用预先生成的sql，只读取一条记录
+                rs = await select(cls.__find_sql__, tuple(pks), 1)
+                found = {pks[0]: rs[0]} if rs else dict()
+            else:
+                sql = '%s where `%s` in (%s)' % (cls.__select_sql__, cls.__primary_key__, ', '.join(['%s'] * len(pks)))
+                rs = await select(sql, tuple(pks))
+                exact = {r[0]: r for r in rs}   # 第一列是主键，优先按数据库返回的主键值匹配
+                found = {pk: exact[pk] for pk in pks if pk in exact}
+                loose = dict()  # 没有被精确匹配的记录，按转换后的主键分组，例如整型主键传入了'5'
+                for r in rs:
+                    if r[0] not in found:
+                        loose.setdefault(_match_key(r[0]), []).append(r)
+                for pk in pks:
+                    if pk not in found:
+                        candidates = loose.get(_match_key(pk))
+                        if candidates and len(candidates) == 1:    # 只有唯一一条记录对应时才使用，否则视为没找到
+                            found[pk] = candidates[0]
+            cols = cls.__select_cols__
+            new, init = cls.__new__, dict.__init__
+            objs = dict()
+            for key, pk in zip(keys, pks):
+                r = found.get(pk)
+                if r is None:
+                    continue
+                row = dict(zip(cols, r))   # 存入缓存的记录，和返回的对象不共享数据
+                if r[0] == pk and _find_loading.get(key) is token:     # 只缓存和数据库主键值一致的键，save/update/delete按对象的主键删除的正是这个键；查询期间记录被修改则不缓存
+                    _cache_store(key, row)
+                obj = objs[pk] = new(cls)
+                init(obj, row)
+            return objs
+        finally:
+            for key in keys:
+                if _find_loading.get(key) is token:
+                    del _find_loading[key]
+
+    @classmethod    # 类方法，清空主键查询缓存
+    def cache_clear(cls):
+        """ 清空当前类的主键查询缓存，Model.cache_clear()清空所有缓存 """
+        if cls is Model:
+            _find_cache.clear()
+            return
+        for key in [k for k in _find_cache if k[0] == cls.__table__]:
+            del _find_cache[key]
 
     async def save(self):
         """ 实例方法，映射插入记录 """
-        args = list(map(self.getValueOrDefault, self.__fields__))   # 非主键类的值列表
-        args.append(self.getValueOrDefault(self.__primary_key__))   # 添加主键值
-        rows = await execute(self.__insert__, args)     # 执行insert语句
+        args = self.__extract_insert_args__(self)    # 非主键列的值，最后是主键值
+        rows = await execute(self.__insert_sql__, args)     # 执行insert语句
+        _cache_forget(self.__class__, args[-1])
+        object.__setattr__(self, '_dirty', set())   # 插入后对象和数据库中的记录一致
         if rows != 1:
-            logging.warning('failed to insert record: affected rows: %s' % rows)
+            logging.warning('failed to insert record: affected rows: %s', rows)
+
+    @classmethod    # 类方法，批量插入记录
+    async def save_many(cls, items, chunk=500):
+        """ 批量插入记录，每chunk行合并成一条多行insert语句，所有语句在一个连接上连续执行，减少与数据库的往返次数 """
+        if not items:   # 没有记录时不占用连接
+            return 0
+        extract = cls.__extract_insert_args__
+        stmts = []
+        for i in range(0, len(items), chunk):
+            part = items[i:i + chunk]
+            sql = cls.__insert_head_sql__ + ', '.join([cls.__insert_row_sql__] * len(part))    # insert into ... value (...), (...)
+            args = list(itertools.chain.from_iterable(map(extract, part)))
+            stmts.append((sql, args))
+        rows = sum(affected for affected, _ in await pipeline(stmts))
+        for obj in items:
+            _cache_forget(cls, obj.getValue(cls.__primary_key__))
+            object.__setattr__(obj, '_dirty', set())
+        if rows != len(items):
+            logging.warning('failed to insert records: affected rows: %s of %s', rows, len(items))
+        return rows
 
     async def update(self):
-        """ 实例方法，映射更新记录 """
-        args = list(map(self.getValue, self.__fields__))
+        """ 实例方法，映射更新记录，只更新被修改过的列 """
+        dirty = getattr(self, '_dirty', None)
+        if not dirty:   # 没有修改过的列，不需要访问数据库
+            return
+        cols = tuple(f for f in self.__fields__ if f in dirty)    # 按列的定义顺序排列，相同的修改组合得到相同的sql
+        args = [self.getValue(k) for k in cols]
         args.append(self.getValue(self.__primary_key__))
-        rows = await execute(self.__update__, args)
+        sql = self.__update_sql__ if len(cols) == len(self.__fields__) else _update_sql(self.__class__, cols)   # 所有列都被修改时直接用元类生成的update语句
+        rows = await execute(sql, args)
+        _cache_forget(self.__class__, args[-1])
+        dirty.clear()
         if rows != 1:
-            logging.warning('failed to update by primary key: affected rows: %s' % rows)
+            logging.warning('failed to update by primary key: affected rows: %s', rows)
 
     async def delete(self):
         """ 实例方法，映射根据主键值删除记录 """
         args = [self.getValue(self.__primary_key__)]
-        rows = await execute(self.__delete__, args)
+        rows = await execute(self.__delete_sql__, args)
+        _cache_forget(self.__class__, args[0])
         if rows != 1:
-            logging.warning('failed to delete by primary key: affected rows: %s' % rows)
+            logging.warning('failed to delete by primary key: affected rows: %s', rows)
 